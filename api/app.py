@@ -1,23 +1,73 @@
+import concurrent.futures
+import functools
 import io
+import os
 import re
+import threading
 from flask import Flask, render_template, request, send_file, abort
-import bibtexparser
-from bibtexparser.bparser import BibTexParser
 
 app = Flask(__name__)
 
+# Uploads a partir deste tamanho são processados no pool de processos;
+# abaixo dele o overhead de serializar ida/volta não compensa
+LIMIAR_POOL = 256 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    # Pool criado sob demanda (não no import, para não penalizar o cold
+    # start) e compartilhado entre requisições do worker
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=os.cpu_count()
+                )
+    return _pool
+
+
+# -----------------------------------------------------------
+#  REGEX PRÉ-COMPILADAS (módulo)
+#  Compiladas uma única vez no import para evitar o custo de
+#  lookup/recompilação a cada chamada em arquivos grandes.
+# -----------------------------------------------------------
+
+_RE_WS = re.compile(r"\s+")
+
+# Tabela para remover chaves "{}" em uma única passada (str.translate)
+_BRACE_DEL = str.maketrans("", "", "{}")
+
+_RE_ENTRY_HEAD = re.compile(r"@\w+\s*\{")
+_RE_EMPTY_HEAD = re.compile(r"@\w+\s*\{\s*,")
+
+# Sonda barata usada pelo upload(): casa um ID vazio ou com espaço em
+# qualquer entrada; se não casar, o arquivo não precisa de correção
+_RE_PROBLEM = re.compile(r"@\w+\s*\{\s*(?:,|[^,]*\s[^,]*,)")
+# Classes de caracteres no lugar de (.+?) com DOTALL: [^{}] casa quebras
+# de linha e roda no loop rápido (memchr) do motor, sem backtracking por
+# posição; o título ainda aceita um nível de chaves aninhadas ({Big})
+_RE_TITLE = re.compile(r"title\s*=\s*\{((?:[^{}]|\{[^{}]*\})*)\}", re.IGNORECASE)
+_RE_YEAR = re.compile(r"year\s*=\s*\{([^{}]*)\}", re.IGNORECASE)
+
 
 # -----------------------------------------------------------
 #  UTIL: gerar ID a partir do TÍTULO + ANO
 # -----------------------------------------------------------
 
+@functools.lru_cache(maxsize=4096)
 def gerar_id_titulo_ano(titulo: str, ano: str) -> str:
-    # Remove chaves do BibTeX e espaços extras
-    titulo = titulo.replace("{", "").replace("}", "").strip()
+    # Remove chaves do BibTeX e espaços extras (uma passada, via translate)
+    titulo = titulo.translate(_BRACE_DEL).strip()
+
+    # Pega a primeira palavra do título (split em C, sem regex)
+    partes = titulo.split(None, 1)
+    primeira = partes[0] if partes else ""
 
-    # Pega a primeira palavra do título
-    primeira = re.split(r"\s+", titulo)[0]
-    primeira = re.sub(r"[^A-Za-z0-9]", "", primeira)
+    # Mantém apenas [A-Za-z0-9], como fazia o regex antigo
+    primeira = "".join(c for c in primeira if c.isalnum() and c.isascii())
 
     if not primeira:
         primeira = "Entry"
@@ -28,119 +78,208 @@ def gerar_id_titulo_ano(titulo: str, ano: str) -> str:
 
 
 # -----------------------------------------------------------
-#  NOVO: CORRIGIR ESPAÇOS NO ID (Raw Regex)
+#  CORRIGIR IDs NO TEXTO BRUTO (Raw Regex, passada única)
 # -----------------------------------------------------------
 
-def corrigir_espacos_ids_raw(conteudo: str) -> str:
-    """
-    Localiza IDs que possuem espaços (ex: @article{Dal Maso2025,)
-    e substitui os espaços por underlines (ex: @article{Dal_Maso2025,).
-    Faz trim (remove espaços nas pontas) antes de substituir os internos.
+def corrigir_ids_raw(conteudo: str) -> str:
     """
-    
-    # Regex Breakdown:
-    # (@\w+\s*{\s*)  -> Grupo 1: Captura "@tipo{" e possíveis espaços iniciais
-    # ([^,]+?)       -> Grupo 2: Captura o ID (tudo até a primeira vírgula, modo non-greedy)
-    # (\s*,)         -> Grupo 3: Captura a vírgula e espaços anteriores
-    pattern = r"(@\w+\s*{\s*)([^,]+?)(\s*,)"
-
-    def replacer(match):
-        prefix = match.group(1)  # ex: @ARTICLE{
-        raw_id = match.group(2)  # ex: Dal Maso2025
-        suffix = match.group(3)  # ex: ,
-
-        # Se não tiver espaço, retorna como está
-        if ' ' not in raw_id:
-            return match.group(0)
-
-        # 1. Remove espaços das bordas (trim) para não criar _Dal_Maso_
-        # 2. Substitui espaços internos por _
-        clean_id = raw_id.strip()
-        
-        # Se após o strip o ID ficar vazio, deixa para a função de ID vazio tratar depois
-        if not clean_id:
-            return match.group(0)
-
-        new_id = re.sub(r"\s+", "_", clean_id)
-        
-        return f"{prefix}{new_id}{suffix}"
+    Corrige IDs diretamente no texto, antes de passar pelo bibtexparser,
+    em uma única varredura do arquivo:
 
-    return re.sub(pattern, replacer, conteudo)
+    - ID vazio (ex: @article{, ...)       -> gera ID a partir de título + ano
+    - ID com espaços (ex: @article{Dal Maso2025,) -> troca espaços por "_"
+    - ID já válido                         -> entrada mantida como está
 
+    Scanner manual: em vez de regex, o arquivo é percorrido uma única vez
+    com str.find (memchr em C) reconhecendo "@tipo{ID," e delimitando o
+    corpo por contagem de chaves balanceadas — sem motor de regex e sem
+    backtracking, mesmo em entradas patológicas.
 
-# -----------------------------------------------------------
-#  CORRIGIR @tipo{, ... } (IDs Vazios) Raw Regex
-# -----------------------------------------------------------
-
-def corrigir_ids_vazios_raw(conteudo: str) -> str:
-    """
-    Corrige entradas com ID vazio diretamente no texto,
-    antes de passar pelo bibtexparser.
+    Devolve (texto_corrigido, n_ids_corrigidos): a contagem sai da própria
+    varredura, sem precisar de um parse separado só para estatística.
     """
-    pattern = r"@(\w+)\s*{\s*,(.*?)}\s*(?=@\w+|$)"
+    saida = []
+    corrigidos = 0
+    n = len(conteudo)
+    pos = 0     # cursor de varredura
+    ultimo = 0  # início do trecho ainda não emitido em `saida`
+
+    while True:
+        arroba = conteudo.find("@", pos)
+        if arroba == -1:
+            break
+
+        # Lê o tipo da entrada (equivalente a \w+)
+        i = arroba + 1
+        while i < n and (conteudo[i].isalnum() or conteudo[i] == "_"):
+            i += 1
+        if i == arroba + 1:
+            pos = arroba + 1
+            continue
+
+        # Pula espaços até a "{" de abertura
+        j = i
+        while j < n and conteudo[j].isspace():
+            j += 1
+        if j >= n or conteudo[j] != "{":
+            pos = i
+            continue
+        brace = j
+
+        # Localiza o "}" que fecha a entrada (chaves balanceadas, via find)
+        depth = 1
+        k = brace + 1
+        while depth:
+            fecha = conteudo.find("}", k)
+            if fecha == -1:
+                break
+            abre = conteudo.find("{", k)
+            if abre != -1 and abre < fecha:
+                depth += 1
+                k = abre + 1
+            else:
+                depth -= 1
+                k = fecha + 1
+
+        if depth:
+            # Entrada sem "}" de fechamento: não mexe
+            pos = brace + 1
+            continue
+        fim = k  # índice logo após o "}" de fechamento
+
+        virgula = conteudo.find(",", brace + 1, fim)
+        if virgula == -1:
+            # Entrada sem campos: nada a corrigir
+            pos = fim
+            continue
+
+        # Pré-filtro barato: IDs limpos (sem espaço interno nem bordas em
+        # branco) são o caso comum e seguem adiante sem alocar a fatia
+        inicio_id = brace + 1
+        if (inicio_id < virgula
+                and conteudo.find(" ", inicio_id, virgula) == -1
+                and not conteudo[inicio_id].isspace()
+                and not conteudo[virgula - 1].isspace()):
+            pos = fim
+            continue
+
+        clean_id = conteudo[inicio_id:virgula].strip()
+        if clean_id and " " not in clean_id:
+            # Só havia espaço em branco nas bordas (ex: tab/quebra de
+            # linha): ID em si é válido, entrada mantida como está
+            pos = fim
+            continue
+
+        tipo = conteudo[arroba + 1:i]
+        body = conteudo[virgula + 1:fim - 1]
 
-    def replacer(match):
-        tipo = match.group(1)
-        body = match.group(2)
+        if not clean_id:
+            # ID vazio: extrair título e ano do corpo e gerar um novo
+            titulo_match = _RE_TITLE.search(body)
+            titulo = titulo_match.group(1).strip() if titulo_match else "Entry"
 
-        # Extrair título
-        titulo_match = re.search(r"title\s*=\s*{(.+?)}", body, re.DOTALL | re.IGNORECASE)
-        titulo = titulo_match.group(1).strip() if titulo_match else "Entry"
+            ano_match = _RE_YEAR.search(body)
+            ano = ano_match.group(1).strip() if ano_match else ""
 
-        # Extrair ano
-        ano_match = re.search(r"year\s*=\s*{(.+?)}", body, re.DOTALL | re.IGNORECASE)
-        ano = ano_match.group(1).strip() if ano_match else ""
+            novo_id = gerar_id_titulo_ano(titulo, ano)
+        else:
+            # ID com espaços internos: trim já feito, troca espaços por _
+            novo_id = _RE_WS.sub("_", clean_id)
 
-        # Gerar novo ID
-        novo_id = gerar_id_titulo_ano(titulo, ano)
+        saida.append(conteudo[ultimo:arroba])
+        saida.append(f"@{tipo}{{{novo_id},{body}}}")
+        corrigidos += 1
+        ultimo = fim
+        pos = fim
 
-        return f"@{tipo}{{{novo_id},{body}}}"
+    if not saida:
+        # Nenhuma correção: devolve a própria string, sem cópia
+        return conteudo, 0
 
-    return re.sub(pattern, replacer, conteudo, flags=re.DOTALL)
+    saida.append(conteudo[ultimo:])
+    return "".join(saida), corrigidos
 
 
 # -----------------------------------------------------------
 #  CORRIGIR IDs RESTANTES usando bibtexparser
 # -----------------------------------------------------------
 
-def gerar_id_unico(entry, existing_ids, fallback_index):
-    year = (entry.get("year") or "").strip()
-    title = (entry.get("title") or "").strip()
+def gerar_id_unico(entry, existing_ids, suffix_of):
+    # Campos de blocos recuperados podem vir com as chaves cruas ({1990})
+    fields = entry.fields_dict
+    year = fields["year"].value.translate(_BRACE_DEL).strip() if "year" in fields else ""
+    title = fields["title"].value.strip() if "title" in fields else ""
 
     base = gerar_id_titulo_ano(title, year)
-    candidate = base
 
-    suffix = 2
-    while candidate in existing_ids:
-        candidate = f"{base}_{suffix}"
+    if base not in existing_ids:
+        existing_ids.add(base)
+        return base
+
+    # suffix_of guarda o próximo sufixo livre por base, evitando refazer
+    # a busca linear base_2, base_3, ... a cada colisão da mesma base
+    suffix = suffix_of.get(base, 2)
+    while (candidate := f"{base}_{suffix}") in existing_ids:
         suffix += 1
 
+    suffix_of[base] = suffix + 1
     existing_ids.add(candidate)
     return candidate
 
 
-def corrigir_bibtex(conteudo_bib):
-    parser = BibTexParser()
-    parser.ignore_nonstandard_types = False
-    
-    try:
-        bib_db = bibtexparser.loads(conteudo_bib, parser=parser)
-    except Exception as e:
-        # Fallback simples se falhar parsing complexo
-        bib_db = bibtexparser.loads(conteudo_bib)
+def corrigir_bibtex(conteudo_bib, corrigidas_raw=0):
+    # Caminho rápido: se a passada bruta não deixou nenhum ID vazio
+    # (o caso comum), não há nada para o bibtexparser corrigir — pula o
+    # round-trip loads/dumps, que domina o tempo em arquivos grandes
+    if not _RE_EMPTY_HEAD.search(conteudo_bib):
+        total_entradas = len(_RE_ENTRY_HEAD.findall(conteudo_bib))
+
+        comentario = (
+            f"% Processamento completo.\n"
+            f"% IDs vazios preenchidos: {corrigidas_raw}\n"
+            f"% IDs com espaços ajustados previamente.\n"
+            f"% Gerado por BibTeX ID Fixer (Flask).\n\n"
+        )
+
+        return comentario + conteudo_bib, total_entradas, corrigidas_raw
 
-    existing_ids = set(e.get("ID") for e in bib_db.entries if e.get("ID"))
-    total_entradas = len(bib_db.entries)
-    total_corrigidas = 0
+    # Import adiado: bibtexparser é pesado e só é necessário nesta etapa,
+    # então GET / e health checks não pagam o custo no cold start
+    # (após a primeira chamada o módulo já está em sys.modules)
+    import bibtexparser
+    from bibtexparser.model import DuplicateBlockKeyBlock, Entry
 
-    for idx, entry in enumerate(bib_db.entries, start=1):
-        entry_id = entry.get("ID", "")
+    # bibtexparser v2: scanner próprio no lugar do pyparsing da série 1.x
+    # (~10x mais rápido) e, ao contrário da 1.x, representa entradas com
+    # ID vazio em vez de rebaixá-las a @comment
+    library = bibtexparser.parse_string(conteudo_bib)
+
+    # Walrus evita materializar/strip a key duas vezes por entrada
+    existing_ids = {key for e in library.entries if (key := (e.key or "").strip())}
+    suffix_of = {}
+    total_corrigidas = corrigidas_raw
+
+    for entry in library.entries:
         # Verifica se está vazio ou None
-        if not entry_id or entry_id.strip() == "":
-            entry["ID"] = gerar_id_unico(entry, existing_ids, idx)
+        if not (entry.key or "").strip():
+            entry.key = gerar_id_unico(entry, existing_ids, suffix_of)
             total_corrigidas += 1
 
-    texto_corrigido = bibtexparser.dumps(bib_db)
+    # Várias entradas com ID vazio colidem entre si e a v2 as marca como
+    # blocos de chave duplicada: recupera a entrada original, gera um ID
+    # e a devolve para a biblioteca
+    for block in list(library.failed_blocks):
+        if not isinstance(block, DuplicateBlockKeyBlock):
+            continue
+        entry = block.ignore_error_block
+        if isinstance(entry, Entry) and not (entry.key or "").strip():
+            entry.key = gerar_id_unico(entry, existing_ids, suffix_of)
+            library.replace(block, entry)
+            total_corrigidas += 1
+
+    total_entradas = len(library.entries)
+
+    texto_corrigido = bibtexparser.write_string(library)
 
     comentario = (
         f"% Processamento completo.\n"
@@ -152,6 +291,74 @@ def corrigir_bibtex(conteudo_bib):
     return comentario + texto_corrigido, total_entradas, total_corrigidas
 
 
+# -----------------------------------------------------------
+#  UTIL: decodificar upload (UTF-8 ou Latin-1)
+# -----------------------------------------------------------
+
+def decodificar_upload(raw: bytes) -> str:
+    """
+    Decodifica o arquivo enviado em uma única passada: testa UTF-8 em uma
+    amostra de 4 KB e só então decodifica o buffer inteiro no encoding
+    escolhido, em vez de decodificar o arquivo completo duas vezes quando
+    ele não é UTF-8.
+    """
+    amostra = raw[:4096]
+    try:
+        amostra.decode("utf-8")
+        encoding = "utf-8"
+    except UnicodeDecodeError as exc:
+        # Erro nos últimos bytes da amostra pode ser apenas um caractere
+        # multibyte cortado pelo recorte; nesse caso mantém UTF-8
+        encoding = "utf-8" if exc.start >= len(amostra) - 3 else "latin-1"
+
+    try:
+        return raw.decode(encoding)
+    except UnicodeDecodeError:
+        # A amostra parecia UTF-8, mas o restante do arquivo não era
+        return raw.decode("latin-1")
+
+
+# -----------------------------------------------------------
+#  PIPELINE COMPLETO (função de módulo: executável no pool)
+# -----------------------------------------------------------
+
+def processar_bib(conteudo: str):
+    """
+    Roda o pipeline de correção (passada bruta + bibtexparser) e devolve
+    (texto_corrigido, total_entradas, total_corrigidas). Função de
+    nível de módulo para poder ser despachada ao ProcessPoolExecutor.
+    """
+    conteudo, corrigidas_raw = corrigir_ids_raw(conteudo)
+    return corrigir_bibtex(conteudo, corrigidas_raw)
+
+
+# -----------------------------------------------------------
+#  UTIL: montar a resposta de download
+# -----------------------------------------------------------
+
+def montar_resposta(output, nome_original, total, corrigidas):
+    # Tamanho obtido do buffer sem cópia (O(1)); com conditional=False o
+    # Flask não precisa sondar/seekar o BytesIO para descobrir o tamanho
+    tamanho = output.getbuffer().nbytes
+
+    base = nome_original.rsplit(".", 1)[0]
+    nome_saida = f"{base}_corrigido.bib"
+
+    response = send_file(
+        output,
+        mimetype="application/x-bibtex",
+        as_attachment=True,
+        download_name=nome_saida,
+        conditional=False,
+    )
+
+    response.headers["Content-Length"] = str(tamanho)
+    response.headers["X-Bibtex-Total"] = str(total)
+    response.headers["X-Bibtex-Corrigidas"] = str(corrigidas)
+
+    return response
+
+
 # -----------------------------------------------------------
 #  ROTAS
 # -----------------------------------------------------------
@@ -172,46 +379,35 @@ def upload():
         abort(400, description="Nenhum arquivo selecionado.")
 
     raw = file.read()
-    try:
-        conteudo = raw.decode("utf-8")
-    except UnicodeDecodeError:
-        conteudo = raw.decode("latin-1")
-
-    # -----------------------------------------------------------
-    # 1) Corrigir IDs com ESPAÇOS no TEXTO BRUTO
-    #    (Executado primeiro para garantir formato válido)
-    # -----------------------------------------------------------
-    conteudo = corrigir_espacos_ids_raw(conteudo)
+    conteudo = decodificar_upload(raw)
 
     # -----------------------------------------------------------
-    # 2) Corrigir IDs vazios no TEXTO BRUTO (regex)
+    # 0) Caminho rápido: arquivo sem nenhum ID vazio ou com espaços
+    #    volta como está — só a varredura da sonda, sem correção nem
+    #    reserialização (caso dominante em uploads de validação)
     # -----------------------------------------------------------
-    conteudo = corrigir_ids_vazios_raw(conteudo)
+    if not _RE_PROBLEM.search(conteudo):
+        total = len(_RE_ENTRY_HEAD.findall(conteudo))
+        return montar_resposta(io.BytesIO(raw), file.filename, total, 0)
 
     # -----------------------------------------------------------
-    # 3) Carregar no bibtexparser e corrigir IDs faltantes remanescentes
+    # 1) Pipeline de correção: passada bruta + bibtexparser.
+    #    Arquivos grandes vão para o pool de processos, liberando a
+    #    thread da requisição e contornando o GIL; pequenos rodam
+    #    inline para não pagar o custo de serialização
     # -----------------------------------------------------------
-    bib_corrigido, total, corrigidas = corrigir_bibtex(conteudo)
-
-    # Criar arquivo de saída
-    output = io.BytesIO()
-    output.write(bib_corrigido.encode("utf-8"))
-    output.seek(0)
-
-    base = file.filename.rsplit(".", 1)[0]
-    nome_saida = f"{base}_corrigido.bib"
-
-    response = send_file(
-        output,
-        mimetype="application/x-bibtex",
-        as_attachment=True,
-        download_name=nome_saida,
-    )
-
-    response.headers["X-Bibtex-Total"] = str(total)
-    response.headers["X-Bibtex-Corrigidas"] = str(corrigidas)
-
-    return response
+    if len(conteudo) >= LIMIAR_POOL:
+        bib_corrigido, total, corrigidas = (
+            obter_pool().submit(processar_bib, conteudo).result()
+        )
+    else:
+        bib_corrigido, total, corrigidas = processar_bib(conteudo)
+
+    # Criar arquivo de saída (BytesIO já inicializado com os bytes,
+    # sem cópia extra via write/seek)
+    output = io.BytesIO(bib_corrigido.encode("utf-8"))
+
+    return montar_resposta(output, file.filename, total, corrigidas)
 
 
 if __name__ == "__main__":